@@ -1,13 +1,26 @@
 import os
 import logging
-from flask import Flask, render_template, request, session
+import pickle
+import threading
+from collections import namedtuple
+from functools import partial
+import click
+from cachetools import TLRUCache
+from flask import Flask, jsonify, render_template, request, session
+from flask.sessions import SecureCookieSessionInterface
+from flask_compress import Compress
 from google.auth.transport.requests import Request
+from google.oauth2 import service_account
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-import pandas as pd
-from difflib import get_close_matches
+from googleapiclient.http import build_http
+import numpy as np
+import orjson
+import redis
+from rapidfuzz import process, fuzz, utils
 
 # Configure logging
 logging.basicConfig(level=logging.ERROR, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -24,13 +37,285 @@ SHEET_RANGES = {
 # Load credentials and token paths from Render's environment variables
 CREDENTIALS_PATH = os.getenv("CREDENTIALS_JSON_PATH", "credentials.json")
 TOKEN_PATH = os.getenv("TOKEN_JSON_PATH", "token.json")
+# A service account key needs no interactive consent, so it takes precedence when set
+SERVICE_ACCOUNT_PATH = os.getenv("SERVICE_ACCOUNT_JSON_PATH")
+
+# Optional Redis instance shared by all workers; sheets are re-fetched after the TTL expires
+REDIS_URL = os.getenv("REDIS_URL")
+SHEET_CACHE_TTL = int(os.getenv("SHEET_CACHE_TTL", "300"))
+# Part of the Redis key; bump it whenever SheetData changes so workers from an older
+# deploy and a newer one never read each other's pickles
+SHARED_CACHE_VERSION = 2
+
+# History lives in the signed session cookie, so only the most recent predictions are kept
+HISTORY_LIMIT = 20
+
+class OrjsonSessionSerializer:
+    """
+    Session serializer backed by orjson instead of the stdlib json module.
+    """
+    def dumps(self, value):
+        # Flask expects the signed cookie value as text
+        return orjson.dumps(value).decode("utf-8")
+
+    def loads(self, value):
+        return orjson.loads(value)
+
+class FastSessionInterface(SecureCookieSessionInterface):
+    """
+    Signed cookie sessions that serialize the session data with orjson.
+    """
+    serializer = OrjsonSessionSerializer()
 
 # Initialize Flask app
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "your_secret_key")  # Replace with a secure random key in production
+app.session_interface = FastSessionInterface()
+Compress(app)  # gzip/brotli responses above the minimum size
+
+# Cache data to avoid multiple API calls: a per-process cache in front of the shared Redis cache.
+# Local entries are (sheet_data, ttl) pairs so a sheet read from Redis expires locally no later
+# than it does in Redis
+sheet_data_cache = TLRUCache(maxsize=len(SHEET_RANGES), ttu=lambda _key, entry, now: now + entry[1])
+# Short timeouts turn an unreachable Redis into a logged cache miss instead of a stalled fetch
+redis_client = (
+    redis.Redis.from_url(REDIS_URL, socket_timeout=1, socket_connect_timeout=1) if REDIS_URL else None
+)
+# cachetools caches aren't thread-safe (even reads touch internal links), so all access goes through this lock
+sheet_data_cache_lock = threading.Lock()
+
+# One lock per sheet so concurrent cache misses trigger a single fetch
+sheet_fetch_locks = {name: threading.Lock() for name in SHEET_RANGES}
+
+# Raw cell values behind the last sheet each process built, kept past the TTL so an
+# unchanged sheet can be re-cached without being parsed again
+last_sheet_values = {}
+
+# Google credentials, loaded once and shared; each thread keeps its own Sheets service
+# because the underlying httplib2 connection is not thread-safe
+sheets_credentials = None
+sheets_local = threading.local()
+# Guards loading and refreshing the shared credentials, which also rewrites TOKEN_PATH
+sheets_credentials_lock = threading.Lock()
+
+# Cached sheet, computed once at load time: a numeric stats matrix addressed by team row,
+# the sport-specific predictor bound to its stat columns, and the team names and their normalized forms
+SheetData = namedtuple(
+    "SheetData", ["team_to_idx", "stats", "predictor", "teams", "normalized", "lookup", "trigrams"]
+)
+
+def get_trigrams(text):
+    """
+    Return the set of 3-character substrings of a normalized string.
+    """
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def to_number(value):
+    """
+    Convert a sheet cell to a float, treating blank or non-numeric cells as 0.
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+def shared_sheet_key(sheet_name):
+    """
+    Return the Redis key for a sheet under the current cache version.
+    """
+    return f"sheet:v{SHARED_CACHE_VERSION}:{sheet_name}"
+
+def load_shared_sheet_data(sheet_name):
+    """
+    Load a sheet from the shared Redis cache as a (sheet_data, remaining_ttl) pair,
+    or return None on a miss.
+    """
+    if redis_client is None:
+        return None
+    key = shared_sheet_key(sheet_name)
+    try:
+        payload, ttl = redis_client.pipeline().get(key).ttl(key).execute()
+    except redis.RedisError as error:
+        logging.error(f"A Redis error occurred: {error}")
+        return None
+    if payload is None:
+        return None
+    try:
+        sheet_data = pickle.loads(payload)
+    except Exception as error:
+        # An entry we can't unpickle is treated as a miss and overwritten by the next fetch
+        logging.error(f"Failed to load cached sheet '{sheet_name}' from Redis: {error}")
+        return None
+    return sheet_data, (ttl if 0 < ttl <= SHEET_CACHE_TTL else SHEET_CACHE_TTL)
+
+def store_shared_sheet_data(sheet_name, sheet_data):
+    """
+    Store a sheet in the shared Redis cache so other workers can reuse it.
+    """
+    if redis_client is None:
+        return
+    try:
+        redis_client.set(shared_sheet_key(sheet_name), pickle.dumps(sheet_data), ex=SHEET_CACHE_TTL)
+    except redis.RedisError as error:
+        logging.error(f"A Redis error occurred: {error}")
+
+def load_credentials():
+    """
+    Load Google credentials from a service account key or the saved OAuth token.
+    """
+    if SERVICE_ACCOUNT_PATH:
+        return service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_PATH, scopes=SCOPES)
+    if not os.path.exists(TOKEN_PATH):
+        raise RuntimeError(f"No OAuth token found at '{TOKEN_PATH}'. Run 'flask --app bettingapp auth' to create one.")
+    return Credentials.from_authorized_user_file(TOKEN_PATH, SCOPES)
+
+def get_sheets_service():
+    """
+    Return this thread's Sheets API service, authorizing with Google on first use.
+    """
+    global sheets_credentials
+
+    with sheets_credentials_lock:
+        if sheets_credentials is None:
+            sheets_credentials = load_credentials()
+        # Service account credentials fetch their own access tokens on first use
+        if not SERVICE_ACCOUNT_PATH and not sheets_credentials.valid:
+            if not (sheets_credentials.expired and sheets_credentials.refresh_token):
+                raise RuntimeError(
+                    "The saved OAuth token is invalid and cannot be refreshed. "
+                    "Run 'flask --app bettingapp auth' to authorize again."
+                )
+            sheets_credentials.refresh(Request())
+            with open(TOKEN_PATH, "w") as token_file:
+                token_file.write(sheets_credentials.to_json())
+
+    service = getattr(sheets_local, "service", None)
+    if service is None:
+        # A single keep-alive transport per thread lets later calls reuse the open TLS connection,
+        # and the bundled discovery document avoids fetching it over the network. build_http
+        # applies googleapiclient's default timeout so a stalled call can't hold a fetch lock forever
+        http = AuthorizedHttp(sheets_credentials, http=build_http())
+        service = build("sheets", "v4", http=http, cache_discovery=False, static_discovery=True)
+        sheets_local.service = service
+    return service
+
+def reset_sheets_service():
+    """
+    Drop the Sheets services in a forked worker so it opens its own connections.
+    """
+    global sheets_local
+    sheets_local = threading.local()
+
+# gunicorn --preload forks workers after the master has prefetched the sheets
+os.register_at_fork(after_in_child=reset_sheets_service)
+
+def build_sheet_data(sheet_name, values):
+    """
+    Build the cached SheetData for a sheet from its raw cell values.
+    """
+    if not values:
+        raise ValueError(f"No data found in the '{sheet_name}' sheet.")
+
+    header = values[0]
+    required_columns = ["Team", "PPG", "OPP PPG"] if sheet_name == "NBA" else ["Team", "G", "PF", "PA"]
+    for col in required_columns:
+        if col not in header:
+            raise ValueError(f"Missing required column '{col}' in the sheet.")
+
+    # The API omits trailing empty cells, so pad short rows to the header width
+    rows = [row + [""] * (len(header) - len(row)) for row in values[1:]]
+    team_col = header.index("Team")
+    stat_cols = [i for i, col in enumerate(header) if col != "Team"]
+
+    columns = {header[col]: i for i, col in enumerate(stat_cols)}
+    stats = np.array([[to_number(row[col]) for col in stat_cols] for row in rows], dtype=np.float64)
+    stats = stats.reshape(len(rows), len(stat_cols))
+
+    # Per-game averages don't change between sheet loads, so compute them once here
+    if sheet_name != "NBA":
+        games = stats[:, columns["G"]]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            averages = np.column_stack((stats[:, columns["PF"]] / games, stats[:, columns["PA"]] / games))
+        columns["avg_for"] = stats.shape[1]
+        columns["avg_against"] = stats.shape[1] + 1
+        stats = np.hstack((stats, averages))
+    team_to_idx = {}
+    for index, row in enumerate(rows):
+        team_to_idx.setdefault(row[team_col], index)
+
+    teams = tuple(team_to_idx)
+    normalized = [utils.default_process(team) for team in teams]
+    # The first team with a given normalized name wins, matching team_to_idx and the trigram scan
+    lookup = {}
+    for name, team in zip(normalized, teams):
+        lookup.setdefault(name, team)
+    trigrams = {}
+    for index, team in enumerate(normalized):
+        for trigram in get_trigrams(team):
+            trigrams.setdefault(trigram, set()).add(index)
+
+    # Bind the stat column indices now so predictions only do integer matrix lookups
+    if sheet_name == "NBA":
+        predictor = partial(predict_nba, columns["PPG"], columns["OPP PPG"])
+    else:
+        predictor = partial(predict_from_averages, columns["avg_for"], columns["avg_against"])
+    return SheetData(team_to_idx, stats, predictor, teams, normalized, lookup, trigrams)
+
+def cache_sheet_data(sheet_name, values):
+    """
+    Store a freshly fetched sheet in the local and shared caches, reusing the
+    previous build when the cell values have not changed.
+    """
+    previous_values, sheet_data = last_sheet_values.get(sheet_name, (None, None))
+    if values != previous_values:
+        sheet_data = build_sheet_data(sheet_name, values)
+        last_sheet_values[sheet_name] = (values, sheet_data)
+
+    with sheet_data_cache_lock:
+        sheet_data_cache[sheet_name] = (sheet_data, SHEET_CACHE_TTL)
+    store_shared_sheet_data(sheet_name, sheet_data)
+    return sheet_data
+
+def get_cached_sheet_data(sheet_name):
+    """
+    Return a sheet from the local cache, falling back to the shared cache, or None on a miss.
+    """
+    with sheet_data_cache_lock:
+        entry = sheet_data_cache.get(sheet_name)
+    if entry is None:
+        entry = load_shared_sheet_data(sheet_name)
+        if entry is None:
+            return None
+        with sheet_data_cache_lock:
+            sheet_data_cache[sheet_name] = entry
+    return entry[0]
+
+def prefetch_all_sheets():
+    """
+    Warm the cache for every sheet with a single batched API request.
+    """
+    sheet_names = list(SHEET_RANGES)
+    try:
+        service = get_sheets_service()
+        result = service.spreadsheets().values().batchGet(
+            spreadsheetId=SPREADSHEET_ID, ranges=[SHEET_RANGES[name] for name in sheet_names]
+        ).execute()
+    except HttpError as error:
+        logging.error(f"An API error occurred: {error}")
+        raise RuntimeError("Failed to fetch data from Google Sheets.")
 
-# Cache data to avoid multiple API calls
-sheet_data_cache = {}
+    for sheet_name, value_range in zip(sheet_names, result.get("valueRanges", [])):
+        cache_sheet_data(sheet_name, value_range.get("values", []))
+
+def warm_sheet_cache():
+    """
+    Prefetch every sheet when the server starts, logging failures so startup continues.
+    Requests fall back to fetching sheets lazily if this fails.
+    """
+    try:
+        prefetch_all_sheets()
+    except Exception as e:
+        logging.error(f"Failed to prefetch sheets: {e}")
 
 def fetch_data_from_sheets(sheet_name):
     """
@@ -44,131 +329,121 @@ def fetch_data_from_sheets(sheet_name):
 
     actual_sheet_name = sheet_ranges_normalized[sheet_name]
 
-    if actual_sheet_name in sheet_data_cache:
-        return sheet_data_cache[actual_sheet_name]
+    cached = get_cached_sheet_data(actual_sheet_name)
+    if cached is not None:
+        return cached
 
-    range_ = SHEET_RANGES[actual_sheet_name]
+    with sheet_fetch_locks[actual_sheet_name]:
+        # Another request may have fetched the sheet while this one waited for the lock
+        cached = get_cached_sheet_data(actual_sheet_name)
+        if cached is not None:
+            return cached
 
-    try:
-        credentials = None
-        if os.path.exists(TOKEN_PATH):
-            credentials = Credentials.from_authorized_user_file(TOKEN_PATH, SCOPES)
-        if not credentials or not credentials.valid:
-            if credentials and credentials.expired and credentials.refresh_token:
-                credentials.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_PATH, SCOPES)
-                credentials = flow.run_local_server(port=0)
-            with open(TOKEN_PATH, "w") as token_file:
-                token_file.write(credentials.to_json())
+        range_ = SHEET_RANGES[actual_sheet_name]
 
-        service = build("sheets", "v4", credentials=credentials)
-        sheets = service.spreadsheets()
-        result = sheets.values().get(spreadsheetId=SPREADSHEET_ID, range=range_).execute()
-        values = result.get("values", [])
-        if not values:
-            raise ValueError(f"No data found in the '{actual_sheet_name}' sheet.")
+        try:
+            service = get_sheets_service()
+            result = service.spreadsheets().values().get(spreadsheetId=SPREADSHEET_ID, range=range_).execute()
+        except HttpError as error:
+            logging.error(f"An API error occurred: {error}")
+            raise RuntimeError("Failed to fetch data from Google Sheets.")
 
-        df = pd.DataFrame(values[1:], columns=values[0])
-        required_columns = ["Team", "PPG", "OPP PPG"] if actual_sheet_name == "NBA" else ["Team", "G", "PF", "PA"]
-        for col in required_columns:
-            if col not in df.columns:
-                raise ValueError(f"Missing required column '{col}' in the sheet.")
+        return cache_sheet_data(actual_sheet_name, result.get("values", []))
 
-        for col in df.columns:
-            if col != "Team":
-                df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0)
+def find_closest_match(user_input, sheet_data):
+    """
+    Find the closest team name match to the user's input using fuzzy matching.
+    """
+    query = utils.default_process(user_input)
+    # Input with no letters or digits normalizes to "", which would match every team
+    if not query:
+        return None
 
-        sheet_data_cache[actual_sheet_name] = df.set_index("Team", drop=False)
-        return sheet_data_cache[actual_sheet_name]
+    if query in sheet_data.lookup:
+        return sheet_data.lookup[query]
 
-    except HttpError as error:
-        logging.error(f"An API error occurred: {error}")
-        raise RuntimeError("Failed to fetch data from Google Sheets.")
+    if len(query) < 3:
+        candidates = range(len(sheet_data.normalized))
+    else:
+        postings = [sheet_data.trigrams.get(trigram, set()) for trigram in get_trigrams(query)]
+        candidates = sorted(set.intersection(*postings))
+
+    for index in candidates:
+        if query in sheet_data.normalized[index]:
+            return sheet_data.teams[index]
 
-def find_closest_match(user_input, team_list):
+    match = process.extractOne(query, sheet_data.normalized, scorer=fuzz.WRatio, processor=None, score_cutoff=60)
+    return sheet_data.teams[match[2]] if match else None
+
+def predict_nba(ppg, opp_ppg, stats, i1, i2):
     """
-    Find the closest team name match to the user's input using fuzzy matching.
+    Predict an NBA total from each team's points scored and allowed per game.
     """
-    user_input = user_input.strip().lower()
-    normalized_teams = [team.lower() for team in team_list]
+    return (stats[i1, ppg] + stats[i1, opp_ppg] + stats[i2, ppg] + stats[i2, opp_ppg]) * 0.5
 
-    for team in normalized_teams:
-        if user_input in team:
-            index = normalized_teams.index(team)
-            return team_list[index]
-
-    matches = get_close_matches(user_input, normalized_teams, n=1, cutoff=0.3)
-    if matches:
-        index = normalized_teams.index(matches[0])
-        return team_list[index]
-    return None
+def predict_from_averages(avg_for, avg_against, stats, i1, i2):
+    """
+    Predict a football total from the per-game averages computed at load time.
+    """
+    return (stats[i1, avg_for] + stats[i1, avg_against] + stats[i2, avg_for] + stats[i2, avg_against]) * 0.5
 
-def calculate_predicted(team1, team2, df, sheet_name):
+def calculate_predicted(team1, team2, sheet_data):
     """
     Generalized function to calculate predicted over/under score.
     """
-    team1_stats = df.loc[team1]
-    team2_stats = df.loc[team2]
-
-    if sheet_name.lower() == "nba":
-        predicted = (team1_stats["PPG"] + team1_stats["OPP PPG"] +
-                     team2_stats["PPG"] + team2_stats["OPP PPG"]) / 2
-    else:
-        team1_avg_for = team1_stats["PF"] / team1_stats["G"]
-        team1_avg_against = team1_stats["PA"] / team1_stats["G"]
-        team2_avg_for = team2_stats["PF"] / team2_stats["G"]
-        team2_avg_against = team2_stats["PA"] / team2_stats["G"]
-        predicted = (team1_avg_for + team1_avg_against +
-                     team2_avg_for + team2_avg_against) / 2
+    i1 = sheet_data.team_to_idx[team1]
+    i2 = sheet_data.team_to_idx[team2]
+    predicted = float(sheet_data.predictor(sheet_data.stats, i1, i2))
 
     return round(predicted, 1)  # Round to the nearest tenth
 
+def run_prediction(sheet_name, team1, team2):
+    """
+    Predict the over/under for a matchup and record it in the session history.
+    Returns a (result, error_message) pair with exactly one of them set.
+    """
+    try:
+        data = fetch_data_from_sheets(sheet_name)
+        team1_match = find_closest_match(team1, data)
+        team2_match = find_closest_match(team2, data)
+
+        if not team1_match or not team2_match:
+            closest_matches = [
+                f"Closest match for '{team1}': {team1_match or 'None'}",
+                f"Closest match for '{team2}': {team2_match or 'None'}"
+            ]
+            error_message = (
+                "One or both team names were not found. Please try again."
+                f" {closest_matches[0]} | {closest_matches[1]}."
+            )
+            return None, error_message
+
+        result = calculate_predicted(team1_match, team2_match, data)
+        entry = {
+            "sheet": sheet_name,
+            "team1": team1_match,
+            "team2": team2_match,
+            "result": f"{result:.1f}"
+        }
+        session["history"] = (session.get("history", []) + [entry])[-HISTORY_LIMIT:]
+        return result, None
+    except ValueError as ve:
+        return None, str(ve)
+    except Exception as e:
+        return None, f"Error: {e}"
+
 @app.route("/", methods=["GET", "POST"])
 def index():
     result = None
     error_message = None
     sheet_name = None
-    teams = []
 
     if request.method == "GET":
         session["history"] = []
 
     if request.method == "POST":
         sheet_name = request.form.get("sheet_name")
-        team1 = request.form.get("team1")
-        team2 = request.form.get("team2")
-
-        try:
-            data = fetch_data_from_sheets(sheet_name)
-            teams = data["Team"].unique()
-            team1_match = find_closest_match(team1, teams)
-            team2_match = find_closest_match(team2, teams)
-
-            if not team1_match or not team2_match:
-                closest_matches = [
-                    f"Closest match for '{team1}': {find_closest_match(team1, teams) or 'None'}",
-                    f"Closest match for '{team2}': {find_closest_match(team2, teams) or 'None'}"
-                ]
-                error_message = (
-                    "One or both team names were not found. Please try again."
-                    f" {closest_matches[0]} | {closest_matches[1]}."
-                )
-            else:
-                result = calculate_predicted(team1_match, team2_match, data, sheet_name)
-                if "history" not in session:
-                    session["history"] = []
-                session["history"].append({
-                    "sheet": sheet_name,
-                    "team1": team1_match,
-                    "team2": team2_match,
-                    "result": f"{result:.1f}"
-                })
-                session.modified = True
-        except ValueError as ve:
-            error_message = str(ve)
-        except Exception as e:
-            error_message = f"Error: {e}"
+        result, error_message = run_prediction(sheet_name, request.form.get("team1"), request.form.get("team2"))
 
     return render_template(
         "index.html",
@@ -178,6 +453,32 @@ def index():
         history=session.get("history", [])
     )
 
+@app.route("/predict", methods=["POST"])
+def predict():
+    """
+    JSON variant of the form POST so the page can update without a full reload.
+    """
+    result, error_message = run_prediction(
+        request.form.get("sheet_name"), request.form.get("team1"), request.form.get("team2")
+    )
+    return jsonify(
+        result=f"{result:.1f}" if result is not None else None,
+        error_message=error_message,
+        history=session.get("history", [])
+    )
+
+@app.cli.command("auth")
+def auth_command():
+    """
+    Run the interactive OAuth consent flow and save the token for the app.
+    """
+    flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_PATH, SCOPES)
+    credentials = flow.run_local_server(port=0)
+    with open(TOKEN_PATH, "w") as token_file:
+        token_file.write(credentials.to_json())
+    click.echo(f"Saved OAuth token to '{TOKEN_PATH}'.")
+
 if __name__ == "__main__":
+    warm_sheet_cache()
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,9 @@
+# Gunicorn settings picked up automatically by the Procfile's web process
+
+def on_starting(server):
+    """
+    Warm the sheet cache in the master so workers forked from a --preload app inherit it.
+    """
+    import bettingapp
+
+    bettingapp.warm_sheet_cache()